@@ -2,34 +2,65 @@ import ibis
 import os
 import ibis.selectors as s
 from ibis import _
-from tempfile import TemporaryFile, NamedTemporaryFile
 import pyarrow.parquet as pq
 import re
 import warnings
+import threading
 import paramiko
 from pathlib import Path
 from time import gmtime, strftime
 
 client = paramiko.SSHClient()
+_duckdb_local = threading.local()
 wrds_id = os.getenv("WRDS_ID")
 warnings.filterwarnings(action='ignore', module='.*paramiko.*')
 
-def df_to_arrow(df, col_types=None, obs=None, batches=False):
+# Pattern used to extract the date from PROC CONTENTS output
+_LAST_MOD_RE = re.compile(r"^Last Modified\s+(.*?)\s{2,}.*$")
+
+def df_to_arrow(df, col_types=None, obs=None, batches=False,
+                chunk_size=1048576):
     
     if col_types:
-        types = set(col_types.values())
-        for type in types:
-            to_convert = [key for (key, value) in col_types.items() if value == type]
-            df = df.mutate(s.across(to_convert, _.cast(type)))
+        # Apply all casts in a single projection
+        df = df.mutate(**{col: _[col].cast(type) 
+                          for (col, type) in col_types.items()})
 
     if obs:
         df = df.limit(obs)
 
     if batches:
-        return df.to_pyarrow_batches()   
+        return df.to_pyarrow_batches(chunk_size=chunk_size)
     else:
         return df.to_pyarrow()
 
+def _combine_patterns(patterns):
+    """Combine a list of regular expressions into a single alternation.
+
+    A single string or compiled pattern is returned unchanged.
+    For compiled patterns in a list only the pattern text is used, so
+    flags must be written inline as scoped groups (e.g., `"(?i:perm)"`);
+    global inline flags such as `"(?i)perm"` are not valid in a list.
+    """
+    if isinstance(patterns, (str, re.Pattern)):
+        return patterns
+    return "|".join(f"(?:{p.pattern if isinstance(p, re.Pattern) else p})" 
+                    for p in patterns)
+
+def _duckdb_connect():
+    """Return an ibis DuckDB connection for exports.
+
+    The connection is created once per thread, so the `postgres`
+    extension is loaded only on a thread's first export. Exports in
+    different threads use separate connections and so do not share
+    DuckDB state or the views registered by `read_postgres()`.
+    """
+    con = getattr(_duckdb_local, "con", None)
+    if con is None:
+        con = ibis.duckdb.connect()
+        _duckdb_local.con = con
+    return con
+
 def db_to_pq(table_name, schema, 
              user=os.getenv("PGUSER", default=os.getlogin()), 
              host=os.getenv("PGHOST", default="localhost"),
@@ -38,12 +69,15 @@ def db_to_pq(table_name, schema,
              data_dir=os.getenv("DATA_DIR", default=""),
              col_types=None,
              row_group_size=1048576,
+             compression="zstd",
+             compression_level=None,
              obs=None,
              modified=None,
              alt_table_name=None,
              keep=None,
              drop=None,
-             batched=True):
+             batched=True,
+             preserve_order=False):
     """Export a PostgreSQL table to a parquet file.
 
     Parameters
@@ -79,6 +113,14 @@ def db_to_pq(table_name, schema,
     row_group_size: int [Optional]
         Maximum number of rows in each written row group. 
         Default is `1024 * 1024`.    
+
+    compression: string [Optional]
+        Compression codec used for the parquet file (e.g., `"snappy"`).
+        Default is `"zstd"`.
+
+    compression_level: int [Optional]
+        Compression level for the codec.
+        The default is to use the codec's own default.
     
     obs: Integer [Optional]
         Number of observations to import from database table.
@@ -92,17 +134,26 @@ def db_to_pq(table_name, schema,
     alt_table_name: string [Optional]
         Basename of parquet file. Used when file should have different name from `table_name`.
 
-    keep: string [Optional]
-        Regular expression indicating columns to keep.
+    keep: string or list of strings [Optional]
+        Regular expression (or list of regular expressions) indicating columns to keep.
+        Flags in a list must be scoped groups (e.g., `"(?i:perm)"`), not `"(?i)perm"`.
         
-    drop: string [Optional]
-        Regular expression indicating columns to drop.
+    drop: string or list of strings [Optional]
+        Regular expression (or list of regular expressions) indicating columns to drop.
+        Flags in a list must be scoped groups (e.g., `"(?i:perm)"`), not `"(?i)perm"`.
     
     batched: bool [Optional]
         Indicates whether data will be extracting in batches using
         `to_pyarrow_batches()` instead of a single call to `to_pyarrow()`.
         Using batches degrades performance slightly, but dramatically 
         reduces memory requirements for large tables.
+
+    preserve_order: bool [Optional]
+        Whether rows are written in the order PostgreSQL returns them.
+        The default (`False`) lets DuckDB interleave rows from its parallel
+        scan tasks, which reduces memory use but means that a table that is
+        physically clustered (e.g., by `permno` and `date`) loses that order
+        in the parquet file, along with tight row-group statistics.
     
     Returns
     -------
@@ -117,41 +168,46 @@ def db_to_pq(table_name, schema,
     if not alt_table_name:
         alt_table_name = table_name
     
-    con = ibis.duckdb.connect()
+    con = _duckdb_connect()
+    # Without the ordering guarantee, DuckDB can stream scan results
+    # from its threads without buffering them to restore row order
+    con.raw_sql(f"SET preserve_insertion_order = {str(preserve_order).lower()}")
     uri = f"postgres://{user}@{host}:{port}/{database}"
     df = con.read_postgres(uri = uri, table_name=table_name, database=schema)
     data_dir = os.path.expanduser(data_dir)
     pq_dir = os.path.join(data_dir, schema)
-    if not os.path.exists(pq_dir):
-        os.makedirs(pq_dir)
+    os.makedirs(pq_dir, exist_ok=True)
     pq_file = os.path.join(data_dir, schema, alt_table_name + '.parquet')
     tmp_pq_file = os.path.join(data_dir, schema, '.temp_' + alt_table_name + '.parquet')
     
     if drop:
-        df = df.drop(s.matches(drop))
+        df = df.drop(s.matches(_combine_patterns(drop)))
         
     if keep:
-        df = df.select(s.matches(keep))
+        df = df.select(s.matches(_combine_patterns(keep)))
     
     if batched:
-        # Get a few rows to infer schema for batched write
-        tmpfile = TemporaryFile()
-        df_arrow = df_to_arrow(df, col_types=col_types, obs=10)
-        pq.write_table(df_arrow, tmpfile)
-        schema = pq.read_schema(tmpfile)
+        # Use the schema of the batch stream itself for the writer,
+        # so no separate query is needed to infer it
+        batches = df_to_arrow(df, col_types=col_types, obs=obs, batches=True,
+                              chunk_size=row_group_size)
+        schema = batches.schema
         if modified:
             schema = schema.with_metadata({b'last_modified': modified.encode()})
         
         # Process data in batches
-        with pq.ParquetWriter(tmp_pq_file, schema) as writer:
-            batches = df_to_arrow(df, col_types=col_types, obs=obs, batches=True)
+        with pq.ParquetWriter(tmp_pq_file, schema, 
+                              compression=compression,
+                              compression_level=compression_level) as writer:
             for batch in batches:
-                writer.write_batch(batch)
+                writer.write_batch(batch, row_group_size=row_group_size)
     else:
         df_arrow = df_to_arrow(df, col_types=col_types, obs=obs)
-        pq.write_table(df_arrow, tmp_pq_file, row_group_size=row_group_size)
+        pq.write_table(df_arrow, tmp_pq_file, row_group_size=row_group_size,
+                       compression=compression,
+                       compression_level=compression_level)
     
-    os.rename(tmp_pq_file, pq_file)
+    os.replace(tmp_pq_file, pq_file)
     return pq_file
 
 def wrds_pg_to_pq(table_name, 
@@ -160,12 +216,15 @@ def wrds_pg_to_pq(table_name,
                   data_dir=os.getenv("DATA_DIR", default=""),
                   col_types=None,
                   row_group_size=1048576,
+                  compression="zstd",
+                  compression_level=None,
                   obs=None,
                   modified=None,
                   alt_table_name=None,
                   keep=None,
                   drop=None,
-                  batched=True):
+                  batched=True,
+                  preserve_order=False):
     """Export a table from the WRDS PostgreSQL database to a parquet file.
 
     Parameters
@@ -196,6 +255,14 @@ def wrds_pg_to_pq(table_name,
     row_group_size: int [Optional]
         Maximum number of rows in each written row group. 
         Default is `1024 * 1024`.    
+
+    compression: string [Optional]
+        Compression codec used for the parquet file (e.g., `"snappy"`).
+        Default is `"zstd"`.
+
+    compression_level: int [Optional]
+        Compression level for the codec.
+        The default is to use the codec's own default.
     
     obs: Integer [Optional]
         Number of observations to import from database table.
@@ -206,17 +273,26 @@ def wrds_pg_to_pq(table_name,
     alt_table_name: string [Optional]
         Basename of parquet file. Used when file should have different name from `table_name`.
 
-    keep: string [Optional]
-        Regular expression indicating columns to keep.
+    keep: string or list of strings [Optional]
+        Regular expression (or list of regular expressions) indicating columns to keep.
+        Flags in a list must be scoped groups (e.g., `"(?i:perm)"`), not `"(?i)perm"`.
         
-    drop: string [Optional]
-        Regular expression indicating columns to drop.
+    drop: string or list of strings [Optional]
+        Regular expression (or list of regular expressions) indicating columns to drop.
+        Flags in a list must be scoped groups (e.g., `"(?i:perm)"`), not `"(?i)perm"`.
 
     batched: bool [Optional]
         Indicates whether data will be extracting in batches using
         `to_pyarrow_batches()` instead of a single call to `to_pyarrow()`.
         Using batches degrades performance slightly, but dramatically 
         reduces memory requirements for large tables.
+
+    preserve_order: bool [Optional]
+        Whether rows are written in the order PostgreSQL returns them.
+        The default (`False`) lets DuckDB interleave rows from its parallel
+        scan tasks, which reduces memory use but means that a table that is
+        physically clustered (e.g., by `permno` and `date`) loses that order
+        in the parquet file, along with tight row-group statistics.
     
     Returns
     -------
@@ -235,12 +311,15 @@ def wrds_pg_to_pq(table_name,
              data_dir=data_dir, 
              col_types=col_types,
              row_group_size=row_group_size,
+             compression=compression,
+             compression_level=compression_level,
              obs=obs,
              modified=modified,
              alt_table_name=alt_table_name,
              keep=keep,
              drop=drop,
-             batched=batched)
+             batched=batched,
+             preserve_order=preserve_order)
 
 def db_schema_tables(schema, 
                      user=os.getenv("PGUSER", default=os.getlogin()), 
@@ -297,7 +376,10 @@ def db_schema_to_pq(schema,
                     port=os.getenv("PGPORT", default=5432),
                     data_dir=os.getenv("DATA_DIR", default=""),
                     row_group_size=1048576,
-                    batched=True):
+                    compression="zstd",
+                    compression_level=None,
+                    batched=True,
+                    preserve_order=False):
     """Export all tables in a PostgreSQL table to parquet files.
 
     Parameters
@@ -332,6 +414,14 @@ def db_schema_to_pq(schema,
     row_group_size: int [Optional]
         Maximum number of rows in each written row group. 
         Default is `1024 * 1024`.    
+
+    compression: string [Optional]
+        Compression codec used for the parquet file (e.g., `"snappy"`).
+        Default is `"zstd"`.
+
+    compression_level: int [Optional]
+        Compression level for the codec.
+        The default is to use the codec's own default.
     
     obs: Integer [Optional]
         Number of observations to import from database table.
@@ -347,6 +437,13 @@ def db_schema_to_pq(schema,
         `to_pyarrow_batches()` instead of a single call to `to_pyarrow()`.
         Using batches degrades performance slightly, but dramatically 
         reduces memory requirements for large tables.
+
+    preserve_order: bool [Optional]
+        Whether rows are written in the order PostgreSQL returns them.
+        The default (`False`) lets DuckDB interleave rows from its parallel
+        scan tasks, which reduces memory use but means that a table that is
+        physically clustered (e.g., by `permno` and `date`) loses that order
+        in the parquet file, along with tight row-group statistics.
     
     Returns
     -------
@@ -367,9 +464,21 @@ def db_schema_to_pq(schema,
                     port=port,
                     data_dir=data_dir,
                     row_group_size=row_group_size,
-                    batched=batched) for table_name in tables]
+                    compression=compression,
+                    compression_level=compression_level,
+                    batched=batched,
+                    preserve_order=preserve_order) for table_name in tables]
     return res
 
+def _connect_client(wrds_id):
+    """(Re)connect the module-level SSH client to the WRDS server."""
+    client.close()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(paramiko.WarningPolicy())
+    client.connect('wrds-cloud-sshkey.wharton.upenn.edu',
+                   username=wrds_id, compress=False)
+    client.get_transport().set_keepalive(30)
+
 def get_process(sas_code, wrds_id=wrds_id, fpath=None):
     """Update a local CSV version of a WRDS table.
 
@@ -389,18 +498,22 @@ def get_process(sas_code, wrds_id=wrds_id, fpath=None):
     -------
     The STDOUT component of the process as a stream.
     """
-    if client:
-        client.close()
-
     if wrds_id:
         """Function runs SAS code on WRDS server and
         returns result as pipe on stdout."""
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        client.connect('wrds-cloud-sshkey.wharton.upenn.edu',
-                       username=wrds_id, compress=False)
+        # Reuse the SSH connection from an earlier call when possible
+        transport = client.get_transport()
+        if not (transport and transport.is_active() and
+                transport.is_authenticated() and
+                transport.get_username() == wrds_id):
+            _connect_client(wrds_id)
         command = "qsas -stdio -noterminal"
-        stdin, stdout, stderr = client.exec_command(command)
+        try:
+            stdin, stdout, stderr = client.exec_command(command)
+        except (paramiko.SSHException, EOFError, OSError):
+            # The reused connection was dropped, so reconnect once
+            _connect_client(wrds_id)
+            stdin, stdout, stderr = client.exec_command(command)
         stdin.write(sas_code)
         stdin.close()
 
@@ -410,7 +523,7 @@ def get_process(sas_code, wrds_id=wrds_id, fpath=None):
         return stdout
 
 def proc_contents(table_name, sas_schema=None, wrds_id=os.getenv("WRDS_ID"), 
-                   encoding=None):
+                   encoding=None, stream=False):
     if not encoding:
         encoding = "utf-8"
     
@@ -418,50 +531,64 @@ def proc_contents(table_name, sas_schema=None, wrds_id=os.getenv("WRDS_ID"),
 
     p = get_process(sas_code, wrds_id)
 
+    if stream:
+        return p
     return p.readlines()
 
 def get_modified_str(table_name, sas_schema, wrds_id=wrds_id,
                      encoding=None):
     
     contents = proc_contents(table_name=table_name, sas_schema=sas_schema, 
-                             wrds_id=wrds_id, encoding=encoding)
+                             wrds_id=wrds_id, encoding=encoding, stream=True)
     
-    if len(contents) == 0:
-        print(f"Table {sas_schema}.{table_name} not found.")
-        return None
-
+    found = False
     modified = ""
     next_row = False
-    for line in contents:
-        if next_row:
-            line = re.sub(r"^\s+(.*)\s+$", r"\1", line)
-            line = re.sub(r"\s+$", "", line)
-            if not re.findall(r"Protection", line):
-                modified += " " + line.rstrip()
-            next_row = False
-
-        if re.match(r"Last Modified", line):
-            modified = re.sub(r"^Last Modified\s+(.*?)\s{2,}.*$",
-                              r"Last modified: \1", line)
-            modified = modified.rstrip()
-            next_row = True
+    try:
+        for line in contents:
+            found = True
+            if next_row:
+                line = line.strip()
+                if "Protection" not in line:
+                    modified += " " + line
+                # Nothing after this line is needed, so stop reading output
+                break
+
+            if line.startswith("Last Modified"):
+                modified = _LAST_MOD_RE.sub(r"Last modified: \1", line)
+                modified = modified.rstrip()
+                next_row = True
+    finally:
+        # Close the channel even on errors, as the SSH connection is reused
+        contents.channel.close()
+    
+    if not found:
+        print(f"Table {sas_schema}.{table_name} not found.")
+        return None
 
     return modified
 
+def _read_last_modified_bytes(file_name):
+    """Read the raw `last_modified` bytes from a parquet file's metadata.
+
+    The footer is parsed as file metadata only (row groups included),
+    so the Arrow schema is never reconstructed.
+    Returns `None` if the file has no `last_modified` value.
+    """
+    file_md = pq.read_metadata(file_name).metadata
+    if not file_md:
+        return None
+    return file_md.get(b'last_modified')
+
 def get_modified_pq(file_name):
     
-    if os.path.exists(file_name):
-        md = pq.read_schema(file_name)
-        schema_md = md.metadata
-        if not schema_md:
-            return ''
-        if b'last_modified' in schema_md.keys():
-            last_modified = schema_md[b'last_modified'].decode('utf-8')
-        else:
-            last_modified = ''
-    else:
-        last_modified = ''
-    return last_modified
+    try:
+        last_modified = _read_last_modified_bytes(file_name)
+    except FileNotFoundError:
+        return ''
+    if last_modified:
+        return last_modified.decode('utf-8')
+    return ''
 
 def wrds_update_pq(table_name, schema, 
                    wrds_id=os.getenv("WRDS_ID", default=""),
@@ -471,11 +598,14 @@ def wrds_update_pq(table_name, schema,
                    encoding="utf-8", 
                    sas_schema=None,
                    row_group_size=1048576,
+                   compression="zstd",
+                   compression_level=None,
                    obs=None,
                    alt_table_name=None,
                    keep=None,
                    drop=None,
-                   batched=True):
+                   batched=True,
+                   preserve_order=False):
     """Export a table from the WRDS PostgreSQL database to a parquet file.
 
     Parameters
@@ -509,6 +639,14 @@ def wrds_update_pq(table_name, schema,
     row_group_size: int [Optional]
         Maximum number of rows in each written row group. 
         Default is `1024 * 1024`.    
+
+    compression: string [Optional]
+        Compression codec used for the parquet file (e.g., `"snappy"`).
+        Default is `"zstd"`.
+
+    compression_level: int [Optional]
+        Compression level for the codec.
+        The default is to use the codec's own default.
     
     obs: Integer [Optional]
         Number of observations to import from database table.
@@ -519,17 +657,26 @@ def wrds_update_pq(table_name, schema,
     alt_table_name: string [Optional]
         Basename of parquet file. Used when file should have different name from `table_name`.
 
-    keep: string [Optional]
-        Regular expression indicating columns to keep.
+    keep: string or list of strings [Optional]
+        Regular expression (or list of regular expressions) indicating columns to keep.
+        Flags in a list must be scoped groups (e.g., `"(?i:perm)"`), not `"(?i)perm"`.
         
-    drop: string [Optional]
-        Regular expression indicating columns to drop.
+    drop: string or list of strings [Optional]
+        Regular expression (or list of regular expressions) indicating columns to drop.
+        Flags in a list must be scoped groups (e.g., `"(?i:perm)"`), not `"(?i)perm"`.
 
     batched: bool [Optional]
         Indicates whether data will be extracting in batches using
         `to_pyarrow_batches()` instead of a single call to `to_pyarrow()`.
         Using batches degrades performance slightly, but dramatically 
         reduces memory requirements for large tables.
+
+    preserve_order: bool [Optional]
+        Whether rows are written in the order PostgreSQL returns them.
+        The default (`False`) lets DuckDB interleave rows from its parallel
+        scan tasks, which reduces memory use but means that a table that is
+        physically clustered (e.g., by `permno` and `date`) loses that order
+        in the parquet file, along with tight row-group statistics.
     
     Returns
     -------
@@ -549,7 +696,7 @@ def wrds_update_pq(table_name, schema,
     if not alt_table_name:
         alt_table_name = table_name
     
-    pq_file = get_pq_file(table_name=table_name, schema=schema, 
+    pq_file = get_pq_file(table_name=alt_table_name, schema=schema, 
                           data_dir=data_dir)
                 
     modified = get_modified_str(table_name=table_name, 
@@ -575,23 +722,22 @@ def wrds_update_pq(table_name, schema,
                   wrds_id=wrds_id,
                   col_types=col_types,
                   row_group_size=row_group_size,
+                  compression=compression,
+                  compression_level=compression_level,
                   obs=obs,
                   modified=modified,
                   alt_table_name=alt_table_name,
                   keep=keep,
                   drop=drop,
-                  batched=batched)
+                  batched=batched,
+                  preserve_order=preserve_order)
     print(f"Completed file download at {get_now()} UTC.\n")
 
 def get_pq_file(table_name, schema, data_dir=os.getenv("DATA_DIR")):
     
     data_dir = os.path.expanduser(data_dir)
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
-
     schema_dir = Path(data_dir, schema)
-    if not os.path.exists(schema_dir):
-        os.makedirs(schema_dir)
+    os.makedirs(schema_dir, exist_ok=True)
         
     pq_file = Path(data_dir, schema, table_name).with_suffix('.parquet')
     return pq_file
@@ -619,10 +765,10 @@ def get_pq_files(schema, data_dir=os.getenv("DATA_DIR", default="")):
     """
     data_dir = os.path.expanduser(data_dir)
     pq_dir = os.path.join(data_dir, schema)
-    files = os.listdir(pq_dir)
-    return [re.sub(r"\.parquet$", "", pq_file) 
-            for pq_file in files
-            if re.search(r"\.parquet$", pq_file)]
+    with os.scandir(pq_dir) as entries:
+        return [entry.name[:-len(".parquet")]
+                for entry in entries
+                if entry.name.endswith(".parquet") and entry.is_file()]
             
 def update_schema(schema, data_dir=os.getenv("DATA_DIR", default="")):
     """Update existing parquet files in a schema.
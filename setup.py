@@ -1,8 +1,7 @@
 import setuptools
+from pathlib import Path
 
-with open("README.md", "r") as f:
-    long_description = f.read()
-    print(long_description)
+long_description = Path("README.md").read_text(encoding="utf-8")
 
 setuptools.setup(
     name="db2pq",